@@ -1,11 +1,21 @@
 #!/usr/bin/python3.5
+import os
+import glob
+import hashlib
+import inspect
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
+from joblib import Parallel, delayed
 from sklearn.linear_model import LinearRegression
 from sklearn.ensemble import RandomForestRegressor
-from keras.models import Sequential
+from lightgbm import LGBMRegressor
+from keras.models import Sequential, Model
 from keras.layers import Dense
 
+TREE_MODELS = ['random-forest', 'gradient-boosting']
+# prefixes of the one-hot encoded blocks (see prepare_data), which tree models get back as integer codes instead
+ONE_HOT_PREFIXES = ['StateHoliday', 'Day']
 
 def remove_closed_stores(df):
     """
@@ -17,20 +27,28 @@ def remove_closed_stores(df):
     return df[df['Open'] != 0]
 
 
-def one_hot_encode(df, target, prefix, excludes=None):
+def one_hot_encode(column, prefix, excludes=None, categories=None):
     """
-    Perform one-hot encoding for a target column in a given pd.DataFrame
-    :param df:
-    :param target: (str) name of the column to one-hot encode
+    Perform one-hot encoding for a given pd.Series
+    :param column: (pd.Series) to one-hot encode
     :param prefix: (str) prefix of the encoding variables
     :param excludes: (list) of encoded column names to drop (including prefix)
-    :return:
+    :param categories: (list) of all values to encode, so that values absent from column still get a column of zeros
+    :return: (OrderedDict) of encoded column name -> int8 indicator array
     """
-    dummy = pd.get_dummies(df[target], prefix=prefix)
-    if excludes is not None:
-        dummy.drop(excludes, axis=1, inplace=True)
-    df.drop([target], axis=1, inplace=True)
-    return df.join(dummy)
+    if categories is None:
+        codes, uniques = pd.factorize(column.values, sort=True)
+    elif column.dtype.name == 'category':
+        # only remaps the existing integer codes, the values themselves are never looked at
+        codes, uniques = column.cat.set_categories(categories).cat.codes.values, categories
+    else:
+        codes, uniques = pd.Categorical(column.values, categories=categories).codes, categories
+
+    # build all indicator columns at once by picking rows of an identity matrix, whose extra last row is all-zero
+    # so that missing values (code -1) stay all-zero, like pd.get_dummies
+    dummy = np.eye(len(uniques) + 1, len(uniques), dtype=np.int8).take(codes, axis=0)
+    names = ['%s_%s' % (prefix, value) for value in uniques]
+    return OrderedDict((name, dummy[:, k]) for k, name in enumerate(names) if excludes is None or name not in excludes)
 
 
 def prepare_data(df, to_drop, has_y=False):
@@ -41,36 +59,39 @@ def prepare_data(df, to_drop, has_y=False):
     :param has_y: (bool) does the df contain the y variable of interest?
     :return:
     """
-
-    # drop features we don't need
-    df = df.drop(to_drop, axis=1)
-
-    # one-hot encode StateHoliday
-    df['StateHoliday'] = df['StateHoliday'].astype(str)
-    df = one_hot_encode(df, 'StateHoliday', 'StateHoliday', excludes=None)
-    for var in ['StateHoliday_0', 'StateHoliday_a', 'StateHoliday_b', 'StateHoliday_c']:
-        if var not in df.columns.values:
-            df[var] = 0
-
-    # norm customers using log_2
-    df['Customers'] = df['Customers'].replace([0], [0.0001])  # prevent nans
-    df['Customers'] = np.log2(df['Customers'])
+    # every output column is computed as an array first and the result is assembled in a single pd.DataFrame,
+    # instead of rewriting the whole frame for each drop/assign/concat
+    columns = OrderedDict()
+    for var in df.columns:
+        # drop features we don't need (StateHoliday and DayOfWeek are replaced by their one-hot encodings below)
+        if var in to_drop or var in ['StateHoliday', 'DayOfWeek']:
+            continue
+        values = df[var].values
+        if var == 'Customers' or (var == 'Sales' and has_y):
+            # norm customers (and sales, only in training data) using log_2
+            # (counts are whole numbers, so flooring at 1 maps 0 to 0 instead of a -13 outlier)
+            values = np.log2(np.maximum(values, 1.0)).astype(np.float32)  # prevent nans
+        elif values.dtype == np.float64:
+            # float32 is enough precision for the models and halves the memory they read
+            values = values.astype(np.float32)
+        elif values.dtype == np.int64:
+            # e.g. flags of a df read without CSV_DTYPES, shrink to the smallest int that fits
+            values = pd.to_numeric(values, downcast='integer')
+        columns[var] = values
+
+    # one-hot encode StateHoliday (mixes 0 and '0' unless it was read as a categorical, whose categories are strings)
+    state_holiday = df['StateHoliday']
+    if state_holiday.dtype.name != 'category':
+        state_holiday = state_holiday.astype(str)
+    columns.update(one_hot_encode(state_holiday, 'StateHoliday', excludes=None, categories=['0', 'a', 'b', 'c']))
 
     # one-hot encode dayofweek
-    df = one_hot_encode(df, 'DayOfWeek', 'Day', excludes=None)
-    for var in ['Day_1', 'Day_2', 'Day_3', 'Day_4', 'Day_5', 'Day_6', 'Day_7']:
-        if var not in df.columns.values:
-            df[var] = 0
+    columns.update(one_hot_encode(df['DayOfWeek'], 'Day', excludes=None, categories=[1, 2, 3, 4, 5, 6, 7]))
 
-    # append Id column
-    df['Id'] = df.index
+    # append Id column (int32 is plenty for row numbers and halves the column)
+    columns['Id'] = df.index.values.astype(np.int32)
 
-    # normalize sales using log_2 (only applicable for training data)
-    if has_y:
-        df['Sales'] = df['Sales'].replace([0], [0.0001])  # prevent nans
-        df['Sales'] = np.log2(df['Sales'])
-
-    return df
+    return pd.DataFrame(columns, index=df.index)
 
 
 def extract_closed_store_ids(df):
@@ -90,238 +111,457 @@ def split_open_closed(test_df):
     return closed_store_ids, test_df
 
 
-def save_for_submission_csv(closed_store_ids, open_store_sales, outfile):
-    open_store_sales = pd.DataFrame(
-        {'Id': open_store_sales.index + 1, 'Sales': np.power(2, open_store_sales.values)})
-    closed_store_sales = pd.DataFrame(
-        {'Id': closed_store_ids + 1, 'Sales': 1})  # 0 sales need to be map to 1 for kaggle
-    submission = pd.concat([open_store_sales, closed_store_sales])
-    submission.to_csv(outfile, index=False)
-    return
+def sort_by_store(df):
+    """
+    Stable-sorts df by 'Store', so that every store is a contiguous block of rows in its original order
+    :param df:
+    :return: df itself if it is already sorted (as returned by read_prepared), else a sorted copy
+    """
+    if df['Store'].is_monotonic_increasing:
+        return df
+    return df.sort_values('Store', kind='mergesort')
 
 
-def train_many_models(train_df, test_df, outfile='output.csv', model_type='linear-regression', verbose=False):
+def store_slices(df):
+    """
+    Gets the contiguous row range of every store in df
+    :param df: DataFrame sorted by 'Store' (see sort_by_store)
+    :return: (dict) of store id -> slice of the store's rows
     """
-    Trains a random forest/linear regressor for each store and generates predictions for all testing input
+    stores = df['Store'].values
+    steps = np.diff(stores)
+    if np.any(steps < 0):
+        raise ValueError('rows must be sorted by Store, see sort_by_store')
+    boundaries = np.concatenate(([0], np.flatnonzero(steps) + 1, [len(stores)]))
+    return {stores[start]: slice(start, stop) for start, stop in zip(boundaries[:-1], boundaries[1:])}
+
+
+def store_blocks(train_df, test_df):
+    """
+    Makes each store a contiguous block of rows in both datasets (free for the already sorted frames of
+    read_prepared), for the per-store models
     :param train_df: processed dataframe of training data
-    :param test_df: processed dataframe of testing data (should not have Sales column)
-    :param model_type: type of model to train
-    :param outfile: name of the output file to write predictions to
-    :return:
+    :param test_df: processed dataframe of testing data
+    :return: (train_df, test_df sorted by Store, dict of store id -> slice of its rows in each)
     """
-    print_feature_list = True
-    print('\nTraining many %s models' % model_type)
-    # special case for closed stores where sales = 0 (or 1 for kaggle's purposes)
-    closed_store_ids, test_df = split_open_closed(test_df)
+    train_df = sort_by_store(train_df)
+    test_df = sort_by_store(test_df)
+    return train_df, test_df, store_slices(train_df), store_slices(test_df)
+
+
+def feature_columns(train_df):
+    """
+    Gets the names of the columns that the models use as features
+    :param train_df: processed dataframe of training data
+    :return: (list) of feature column names
+    """
+    return [var for var in train_df.columns.values.tolist() if var not in ['Id', 'Sales', 'Store', 'Open']]
 
-    train_stores = dict(list(train_df.groupby('Store')))
-    test_stores = dict(list(test_df.groupby('Store')))
-    open_store_sales = pd.Series()
-    train_scores = []
-    for i in test_stores:
-        current_store = train_stores[i]
 
-        # define training and testing sets
-        train_x = current_store.drop(['Id', 'Sales', 'Store', 'Open'], axis=1)
+def feature_matrix(df, feature_cols):
+    """
+    Gets the features of df as a single C-contiguous float32 matrix, which sklearn and keras use without copying
+    :param df: processed dataframe
+    :param feature_cols: (list) of feature column names
+    :return: (np.ndarray) of shape (len(df), len(feature_cols))
+    """
+    return np.ascontiguousarray(df[feature_cols].values, dtype=np.float32)
 
-        if print_feature_list:
-            print('Features: %s' % train_x.columns.values.tolist())
-            print_feature_list = False
 
-        train_y = current_store['Sales']
+def tree_feature_matrix(df, feature_cols):
+    """
+    Like feature_matrix, but collapses each one-hot encoded block (StateHoliday_*, Day_*) back into a single integer
+    coded column: trees split on the codes directly, so they search 2 columns instead of 11
+    :param df: processed dataframe
+    :param feature_cols: (list) of feature column names
+    :return: (np.ndarray of shape (len(df), n_features), list of feature names, list of indices of the coded columns)
+    """
+    plain_cols = [var for var in feature_cols if not var.startswith(tuple('%s_' % p for p in ONE_HOT_PREFIXES))]
+    columns = [df[plain_cols].values]
+    for prefix in ONE_HOT_PREFIXES:
+        block = df[[var for var in feature_cols if var.startswith('%s_' % prefix)]].values
+        # the position of a row's 1 is its category code, and rows without any 1 (values outside the encoded
+        # categories, see one_hot_encode) get a code of their own rather than the first category's
+        codes = block.argmax(axis=1)
+        codes[block.max(axis=1) == 0] = block.shape[1]
+        columns.append(codes[:, np.newaxis])
+    x = np.ascontiguousarray(np.hstack(columns), dtype=np.float32)
+    categorical = list(range(len(plain_cols), len(plain_cols) + len(ONE_HOT_PREFIXES)))
+    return x, plain_cols + ONE_HOT_PREFIXES, categorical
+
+
+def model_feature_matrices(train_df, test_df, model_type):
+    """
+    Gets the training and testing features in the encoding model_type works best with: integer codes for the
+    categorical features of tree models (see tree_feature_matrix), one-hot encoding for everything else
+    :param train_df: processed dataframe of training data
+    :param test_df: processed dataframe of testing data
+    :param model_type: type of model to train
+    :return: (train_x, test_x, list of feature names, list of indices of the coded columns or None)
+    """
+    feature_cols = feature_columns(train_df)
+    if model_type in TREE_MODELS:
+        train_x, features, categorical = tree_feature_matrix(train_df, feature_cols)
+        test_x, _, _ = tree_feature_matrix(test_df, feature_cols)
+        return train_x, test_x, features, categorical
+    return feature_matrix(train_df, feature_cols), feature_matrix(test_df, feature_cols), feature_cols, None
 
-        test_x = test_stores[i].copy()
-        open_store_ids = test_x['Id']
-        test_x = test_x.drop(['Id', 'Store'], axis=1)
 
-        model = None
-        if model_type == 'linear-regression':
-            model = LinearRegression()
-        elif model_type == 'random-forest':
-            model = RandomForestRegressor(n_estimators=100, max_depth=10, oob_score=True)
-        else:
-            model = LinearRegression()
+def save_for_submission_csv(closed_store_ids, open_store_ids, open_store_sales, outfile):
+    """
+    Writes the kaggle submission for the predicted (log2) sales of the open testing data
+    :param closed_store_ids: Ids of the closed testing data, as returned by split_open_closed
+    :param open_store_ids: (np.ndarray) Ids of the open testing data
+    :param open_store_sales: (np.ndarray) predicted log2 sales of open_store_ids, in the same order
+    :param outfile: name of the output file to write predictions to
+    :return:
+    """
+    # write open and closed stores straight into one preallocated pair of columns
+    n_open = len(open_store_ids)
+    ids = np.empty(n_open + len(closed_store_ids), dtype=np.int32)
+    sales = np.empty(len(ids), dtype=np.float64)
+    ids[:n_open] = open_store_ids + 1
+    np.exp2(open_store_sales, out=sales[:n_open])
+    ids[n_open:] = np.asarray(closed_store_ids) + 1
+    sales[n_open:] = 1  # 0 sales need to be map to 1 for kaggle
+    submission = pd.DataFrame({'Id': ids, 'Sales': sales}, columns=['Id', 'Sales'])
+    submission.to_csv(outfile, index=False)
+    return
+
 
+def _fit_predict_store(i, train_x, train_y, test_x, model_type, categorical=None, verbose=False):
+    """
+    Fits a random forest/gradient boosting regressor on a single store and predicts its testing input (linear
+    regression fits all stores at once instead, see _fit_predict_linear_stores).
+    Runs inside a joblib worker, so it must only depend on its arguments.
+    :param i: id of the store
+    :param train_x: (np.ndarray) training features of store i
+    :param train_y: (np.ndarray) training sales of store i
+    :param test_x: (np.ndarray) (open) testing features of store i
+    :param model_type: type of model to train, one of TREE_MODELS
+    :param categorical: (list) of indices of the integer coded categorical columns, for gradient boosting
+    :param verbose: verbosity
+    :return: (np.ndarray of predictions, training score)
+    """
+    if model_type == 'random-forest':
+        # single-threaded: parallelism is across stores, nesting would oversubscribe the cores
+        model = RandomForestRegressor(n_estimators=100, max_depth=10, n_jobs=1)
+    else:
+        # gradient-boosting, histogram-based: features are binned once, so each split scans bins rather than rows
+        # (a single store has few rows, so allow smaller leaves and categories than lightgbm's defaults of 20 and 100,
+        # and ask for no more leaves than the store has rows for, instead of a default of 31 it can never grow)
+        min_child_samples = 5
+        num_leaves = int(np.clip(len(train_y) // min_child_samples, 2, 31))
+        model = LGBMRegressor(n_estimators=100, max_depth=8, num_leaves=num_leaves, learning_rate=0.1,
+                              min_child_samples=min_child_samples, min_data_per_group=5, n_jobs=1, verbose=-1)
+
+    if model_type == 'gradient-boosting' and categorical:
+        model.fit(train_x, train_y, categorical_feature=categorical)
+    else:
         model.fit(train_x, train_y)
-        test_y = model.predict(test_x)
-        train_scores.append(model.score(train_x, train_y))
+    test_y = model.predict(test_x)
+    train_score = model.score(train_x, train_y)
+
+    if verbose:
+        print('Completed Store %d: train_score=%.5f' % (i, train_score))
 
-        # append predicted values of current store to submission
-        open_store_sales = open_store_sales.append(pd.Series(test_y, index=open_store_ids))
+    return test_y, train_score
 
+
+def _fit_predict_linear_stores(train_x, train_y, train_stores, test_x, test_stores, stores):
+    """
+    Fits an ordinary least squares regressor (with intercept) for each store, solving the normal equations of
+    all stores in a single batched np.linalg.solve instead of one sklearn LinearRegression per store.
+    :param train_x: (np.ndarray) training features, rows grouped by store
+    :param train_y: (np.ndarray) training sales
+    :param train_stores: (dict) of store id -> slice of the store's rows in train_x
+    :param test_x: (np.ndarray) testing features, rows grouped by store
+    :param test_stores: (dict) of store id -> slice of the store's rows in test_x
+    :param stores: store ids to fit, in the order their rows appear in test_x
+    :return: (predictions for test_x, np.ndarray of training R^2 per store)
+    """
+    n_features = train_x.shape[1]
+    x_means = np.empty((len(stores), n_features))
+    y_means = np.empty(len(stores))
+    xtx = np.empty((len(stores), n_features, n_features))
+    xty = np.empty((len(stores), n_features))
+    yty = np.empty(len(stores))
+    for k, i in enumerate(stores):
+        # center on the store's means so that the intercept drops out of the normal equations
+        x = train_x[train_stores[i]].astype(np.float64)
+        y = train_y[train_stores[i]].astype(np.float64)
+        x_means[k] = x.mean(axis=0)
+        # the mean of constant sales is taken exactly, so that they center to exactly 0 (see R^2 below)
+        y_means[k] = y[0] if y.min() == y.max() else y.mean()
+        x -= x_means[k]
+        y -= y_means[k]
+        xtx[k] = x.T.dot(x)
+        xty[k] = x.T.dot(y)
+        yty[k] = y.dot(y)
+
+    # the one-hot columns are collinear (and constant ones are all-zero after centering),
+    # a tiny ridge keeps every system non-singular without moving the least squares fit
+    betas = np.linalg.solve(xtx + 1e-8 * np.eye(n_features), xty[:, :, np.newaxis])[:, :, 0]
+    intercepts = y_means - np.einsum('sp,sp->s', x_means, betas)
+
+    # R^2 = 1 - SS_res / SS_tot, with SS_res expanded in terms of the normal equations
+    ss_res = yty - 2 * np.einsum('sp,sp->s', betas, xty) + np.einsum('sp,spq,sq->s', betas, xtx, betas)
+    # like sklearn's r2_score, a store with constant sales (SS_tot = 0, e.g. a single row) scores 1 when it is
+    # fitted exactly and 0 otherwise, instead of dividing by zero
+    constant = yty == 0
+    train_scores = np.where(constant, np.where(ss_res == 0, 1.0, 0.0), 1 - ss_res / np.where(constant, 1.0, yty))
+
+    # predict every testing row with the coefficients of its store
+    counts = [test_stores[i].stop - test_stores[i].start for i in stores]
+    row_store = np.repeat(np.arange(len(stores)), counts)
+    test_y = np.einsum('np,np->n', test_x, betas[row_store]) + intercepts[row_store]
+    return test_y, train_scores
+
+
+def train_many_models(train_df, test_df, closed_store_ids, outfile='output.csv', model_type='linear-regression',
+                      verbose=False, n_jobs=-1):
+    """
+    Trains a random forest/gradient boosting/linear regressor for each store and generates predictions for all testing
+    input
+    :param train_df: processed dataframe of training data
+    :param test_df: processed dataframe of open testing data, as returned by split_open_closed
+    :param closed_store_ids: Ids of the closed testing data, as returned by split_open_closed
+    :param model_type: type of model to train
+    :param outfile: name of the output file to write predictions to
+    :param verbose: verbosity
+    :param n_jobs: number of worker processes fitting stores in parallel (-1 for one per core)
+    :return:
+    """
+    print('\nTraining many %s models' % model_type)
+    train_df, test_df, train_stores, test_stores = store_blocks(train_df, test_df)
+    # extract the arrays once, each store is then just a (still C-contiguous) row slice of them
+    train_x, test_x, features, categorical = model_feature_matrices(train_df, test_df, model_type)
+    train_y = train_df['Sales'].values
+    print('Features: %s' % features)
+
+    # in store order, the testing rows of all stores are exactly the rows of (sorted) test_df
+    stores = sorted(test_stores)
+    if model_type in TREE_MODELS:
+        # stores are independent of each other, so fit them in parallel
+        results = Parallel(n_jobs=n_jobs, backend='loky', batch_size='auto')(
+            delayed(_fit_predict_store)(i, train_x[train_stores[i]], train_y[train_stores[i]], test_x[test_stores[i]],
+                                        model_type, categorical, verbose)
+            for i in stores)
+        test_y = np.concatenate([r[0] for r in results])
+        train_scores = [r[1] for r in results]
+    else:
+        # linear regression: solve the least squares problems of all stores in one batch
+        test_y, train_scores = _fit_predict_linear_stores(train_x, train_y, train_stores, test_x, test_stores, stores)
         if verbose:
-            print('Completed Store %d: train_score=%.5f' % (i, train_scores[-1]))
+            for i, train_score in zip(stores, train_scores):
+                print('Completed Store %d: train_score=%.5f' % (i, train_score))
 
     # save to csv file
-    save_for_submission_csv(closed_store_ids, open_store_sales, outfile)
+    save_for_submission_csv(closed_store_ids, test_df['Id'].values, test_y, outfile)
     print('mean(train_score)=%.5f' % np.mean(train_scores))
     print('sd(train_score)=%.5f' % np.std(train_scores))
     print('done: wrote predictions to %s' % outfile)
     return
 
 
-def train_single_model(train_df, test_df, model_type='linear-regression', outfile='out.csv'):
+def train_single_model(train_df, test_df, closed_store_ids, model_type='linear-regression', outfile='out.csv'):
     """
     Trains a "monolithic" model (i.e. across all stores)
     :param train_df: processed dataframe of training data
-    :param test_df: processed dataframe of testing data (should not have Sales column)
+    :param test_df: processed dataframe of open testing data, as returned by split_open_closed
+    :param closed_store_ids: Ids of the closed testing data, as returned by split_open_closed
     :param model_type: type of model to train
     :param outfile: name of the output file to write predictions to
     :return:
     """
     print('\nTraining monolithic %s model' % model_type)
-    # special case for closed stores where sales = 0 (or 1 for kaggle's purposes)
-    closed_store_ids, test_df = split_open_closed(test_df)
-
-    train_y = train_df['Sales']
-    train_x = train_df.drop(['Id', 'Sales', 'Open', 'Store'], axis=1)
-
-    open_store_ids = test_df['Id']
-    test_x = test_df.drop(['Id', 'Store'], axis=1)
-
-    print('Features: %s' % train_x.columns.values.tolist())
+    train_y = train_df['Sales'].values
+    open_store_ids = test_df['Id'].values
+    train_x, test_x, features, categorical = model_feature_matrices(train_df, test_df, model_type)
+    print('Features: %s' % features)
 
     model = None
     if model_type == 'linear-regression':
         model = LinearRegression()
     elif model_type == 'random-forest':
-        model = RandomForestRegressor(n_estimators=100, max_depth=10, oob_score=True)
+        model = RandomForestRegressor(n_estimators=100, max_depth=10, n_jobs=-1)
+    elif model_type == 'gradient-boosting':
+        model = LGBMRegressor(n_estimators=100, max_depth=8, learning_rate=0.1, n_jobs=-1, verbose=-1)
     else:
         model = LinearRegression()
 
-    model.fit(train_x, train_y)
+    if model_type == 'gradient-boosting':
+        model.fit(train_x, train_y, categorical_feature=categorical)
+    else:
+        model.fit(train_x, train_y)
 
     test_y = model.predict(test_x)
     train_score = model.score(train_x, train_y)
 
-    open_store_sales = pd.Series().append(pd.Series(test_y, index=open_store_ids))
-
     # save to csv file
-    save_for_submission_csv(closed_store_ids, open_store_sales, outfile)
+    save_for_submission_csv(closed_store_ids, open_store_ids, test_y, outfile)
     print('train_score=%.5f' % train_score)
     print('done: wrote predictions to %s' % outfile)
     return
 
 
-def train_single_keras_model(train_df, test_df, outfile='out.csv'):
+def build_keras_model(input_dim):
+    """
+    Creates and compiles the keras neural network shared by the keras models
+    :param input_dim: number of features
+    :return: the compiled keras model
+    """
+    model = Sequential()
+    model.add(Dense(input_dim, input_dim=input_dim, kernel_initializer='normal', activation='relu'))
+    model.add(Dense(512, kernel_initializer='normal'))
+    model.add(Dense(64, kernel_initializer='normal'))
+    model.add(Dense(1))
+    model.compile(loss='mean_squared_error', optimizer='adam')
+    return model
+
+
+def train_single_keras_model(train_df, test_df, closed_store_ids, outfile='out.csv', epochs=25, batch_size=64):
     """
     Trains a keras neural network over all stores.
     :param train_df: processed dataframe of training data
-    :param test_df: processed dataframe of testing data (should not have Sales column)
+    :param test_df: processed dataframe of open testing data, as returned by split_open_closed
+    :param closed_store_ids: Ids of the closed testing data, as returned by split_open_closed
     :param outfile: name of the output file to write predictions to
+    :param epochs: number of training epochs
+    :param batch_size: training batch size (use a few thousand to keep a GPU busy)
     :return:
     """
     print('\nTraining keras model')
-    # special case for closed stores where sales = 0 (or 1 for kaggle's purposes)
-    closed_store_ids, test_df = split_open_closed(test_df)
-
-    train_y = train_df['Sales']
-    train_x = train_df.drop(['Id', 'Sales', 'Open', 'Store'], axis=1)
-
-    open_store_ids = test_df['Id']
-    test_x = test_df.drop(['Id', 'Store'], axis=1)
-
-    print('Features: %s' % train_x.columns.values.tolist())
+    feature_cols = feature_columns(train_df)
+    print('Features: %s' % feature_cols)
 
-    # cast to numpy arrays for keras
-    train_x = np.array(train_x)
-    train_y = np.array(train_y)
-    test_x = np.array(test_x)
+    # cast to C-contiguous float32 arrays for keras
+    train_y = np.ascontiguousarray(train_df['Sales'].values, dtype=np.float32)
+    train_x = feature_matrix(train_df, feature_cols)
 
-    # create model
-    model = Sequential()
-    model.add(Dense(np.shape(train_x)[1], input_dim=np.shape(train_x)[1], kernel_initializer='normal', activation='relu'))
-    model.add(Dense(512, kernel_initializer='normal'))
-    model.add(Dense(64, kernel_initializer='normal'))
-    model.add(Dense(1))
-    model.compile(loss='mean_squared_error', optimizer='adam')
+    open_store_ids = test_df['Id'].values
+    test_x = feature_matrix(test_df, feature_cols)
 
-    model.fit(train_x, train_y, epochs=25, batch_size=64, verbose=0, shuffle=True)
-    test_y = model.predict(test_x)
+    model = build_keras_model(np.shape(train_x)[1])
+    model.fit(train_x, train_y, epochs=epochs, batch_size=batch_size, verbose=0, shuffle=True)
+    test_y = model.predict(test_x, batch_size=1024)
 
-    open_store_sales = pd.Series().append(pd.Series(test_y.ravel(), index=open_store_ids))
-    save_for_submission_csv(closed_store_ids, open_store_sales, outfile)
+    save_for_submission_csv(closed_store_ids, open_store_ids, test_y.ravel(), outfile)
     print('done: wrote predictions to %s' % outfile)
     return
 
 
-def train_many_keras_models(train_df, test_df, outfile='output.csv', verbose=False):
+def train_many_keras_models(train_df, test_df, closed_store_ids, outfile='output.csv', verbose=False, epochs=25,
+                            batch_size=64):
     """
-    Trains a keras neural network for each store and generates predictions for all testing input
+    Trains a keras neural network over all stores, then refits its output layer for each store and generates
+    predictions for all testing input
     :param train_df: processed dataframe of training data
-    :param test_df: processed dataframe of testing data (should not have Sales column)
+    :param test_df: processed dataframe of open testing data, as returned by split_open_closed
+    :param closed_store_ids: Ids of the closed testing data, as returned by split_open_closed
     :param outfile: name of the output file to write predictions to
     :param verbose: verbosity
+    :param epochs: number of epochs to train the shared network for
+    :param batch_size: training batch size of the shared network (use a few thousand to keep a GPU busy)
     :return:
     """
-    print_feature_list = True
     print('\nTraining many keras models')
-    # special case for closed stores where sales = 0 (or 1 for kaggle's purposes)
-    closed_store_ids, test_df = split_open_closed(test_df)
-
-    train_stores = dict(list(train_df.groupby('Store')))
-    test_stores = dict(list(test_df.groupby('Store')))
-    open_store_sales = pd.Series()
-    for i in test_stores:
-        current_store = train_stores[i]
+    train_df, test_df, train_stores, test_stores = store_blocks(train_df, test_df)
+    feature_cols = feature_columns(train_df)
+    print('Features: %s' % feature_cols)
+
+    # cast to C-contiguous float32 arrays once, so each store is a zero-copy row slice keras can use as is
+    train_x = feature_matrix(train_df, feature_cols)
+    train_y = np.ascontiguousarray(train_df['Sales'].values, dtype=np.float32)
+    test_x = feature_matrix(test_df, feature_cols)
+    open_store_ids = test_df['Id'].values
+
+    # create the model and train its hidden layers once, on all stores
+    model = build_keras_model(np.shape(train_x)[1])
+    model.fit(train_x, train_y, epochs=epochs, batch_size=batch_size, verbose=0, shuffle=True)
+
+    # with the hidden layers frozen, fitting a store's 64 -> 1 output layer is a linear regression on the last hidden
+    # layer's activations, so compute those once for all rows and solve the output layers of all stores in one batch
+    hidden = Model(inputs=model.inputs, outputs=model.layers[-2].output)
+    train_z = hidden.predict(train_x, batch_size=1024)
+    test_z = hidden.predict(test_x, batch_size=1024)
+
+    stores = sorted(test_stores)
+    test_y, train_scores = _fit_predict_linear_stores(train_z, train_y, train_stores, test_z, test_stores, stores)
+    if verbose:
+        for i, train_score in zip(stores, train_scores):
+            print('Completed Store %d: train_score=%.5f' % (i, train_score))
 
-        # define training and testing sets
-        train_x = current_store.drop(['Id', 'Sales', 'Store', 'Open'], axis=1)
-
-        if print_feature_list:
-            print('Features: %s' % train_x.columns.values.tolist())
-            print_feature_list = False
-
-        train_y = current_store['Sales']
-
-        test_x = test_stores[i].copy()
-        open_store_ids = test_x['Id']
-        test_x = test_x.drop(['Id', 'Store'], axis=1)
-
-        # cast to numpy arrays for keras
-        train_x = np.array(train_x)
-        train_y = np.array(train_y)
-        test_x = np.array(test_x)
+    # save to csv file
+    save_for_submission_csv(closed_store_ids, open_store_ids, test_y, outfile)
+    print('mean(train_score)=%.5f' % np.mean(train_scores))
+    print('sd(train_score)=%.5f' % np.std(train_scores))
+    print('done: wrote predictions to %s' % outfile)
+    return
 
-        # create model
-        model = Sequential()
-        model.add(Dense(np.shape(train_x)[1], input_dim=np.shape(train_x)[1], kernel_initializer='normal', activation='relu'))
-        model.add(Dense(512, kernel_initializer='normal'))
-        model.add(Dense(64, kernel_initializer='normal'))
-        model.add(Dense(1))
-        model.compile(loss='mean_squared_error', optimizer='adam')
 
-        model.fit(train_x, train_y, epochs=50, batch_size=32, verbose=0, shuffle=True)
-        test_y = model.predict(test_x)
+def prepared_data_key():
+    """
+    Gets a fingerprint of everything that determines the processed DataFrames: the csv column types and the source of
+    the functions read_prepared applies. Editing the rest of this script (e.g. picking a model below) keeps it the same
+    :return: (str) short hex digest
+    """
+    digest = hashlib.md5(repr(sorted(CSV_DTYPES.items())).encode('utf-8'))
+    for func in [read_prepared, remove_closed_stores, prepare_data, one_hot_encode, sort_by_store]:
+        digest.update(inspect.getsource(func).encode('utf-8'))
+    return digest.hexdigest()[:12]
 
-        # append predicted values of current store to submission
-        open_store_sales = open_store_sales.append(pd.Series(test_y.ravel(), index=open_store_ids))
 
-        if verbose:
-            print('Completed Store %d' % i)
+def read_prepared(csv_file, cache_name, has_y=False):
+    """
+    Reads and processes a dataset, caching the processed DataFrame so that later runs skip the csv parsing and
+    prepare_data altogether (the cache file is keyed on prepared_data_key, and rebuilt whenever the csv is newer;
+    writing it removes the caches of other keys)
+    :param csv_file: (str) path of the raw csv
+    :param cache_name: (str) path of the pickled processed DataFrame, without the key and extension
+    :param has_y: (bool) does the df contain the y variable of interest?
+    :return: the processed DataFrame, sorted by Store
+    """
+    cache_file = '%s_%s.pkl' % (cache_name, prepared_data_key())
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(csv_file):
+        return pd.read_pickle(cache_file)
 
-    # save to csv file
-    save_for_submission_csv(closed_store_ids, open_store_sales, outfile)
-    print('done: wrote predictions to %s' % outfile)
-    return
+    df = pd.read_csv(csv_file, dtype=CSV_DTYPES)
+    if has_y:
+        # closed stores are never trained on, so drop them before doing any feature engineering on their rows
+        df = remove_closed_stores(df)
+    df = prepare_data(df, to_drop=['Date'], has_y=has_y)
+    # sort by store once here (and cache it), so that the per-store models never have to
+    df = sort_by_store(df).reset_index(drop=True)
+    df.to_pickle(cache_file)
+    # the caches of earlier keys can never be read again, so don't let them pile up
+    for stale_file in glob.glob('%s_%s.pkl' % (cache_name, '[0-9a-f]' * 12)):
+        if stale_file != cache_file:
+            os.remove(stale_file)
+    return df
 
 
 # read and process datasets
 CSV_TRAIN = 'train_v2.csv'
 CSV_TEST = 'test_v2.csv'
 
-train = pd.read_csv(CSV_TRAIN, low_memory=False)
-test = pd.read_csv(CSV_TEST, low_memory=False)
+# explicit column types, so the parser needs no type inference (test has no Sales, which is fine)
+CSV_DTYPES = {'Store': np.int32, 'DayOfWeek': np.int8, 'Sales': np.float32, 'Customers': np.float32,
+              'Open': np.int8, 'Promo': np.int8, 'StateHoliday': 'category', 'SchoolHoliday': np.int8}
 
-train = prepare_data(train, to_drop=['Date'], has_y=True)
-train = remove_closed_stores(train)
+train = read_prepared(CSV_TRAIN, 'train_prepared', has_y=True)
+test = read_prepared(CSV_TEST, 'test_prepared', has_y=False)
 
-test = prepare_data(test, to_drop=['Date'], has_y=False)
+# special case for closed stores where sales = 0 (or 1 for kaggle's purposes), shared by all the models below
+closed_store_ids, test = split_open_closed(test)
 
 # train models
-train_many_models(train, test, outfile='rossmann-lr-per-store.csv', model_type='linear-regression', verbose=False)
-#train_many_models(train, test, outfile='rossmann-rf-per-store.csv', model_type='random-forest', verbose=False)
-#train_single_model(train, test, outfile='rossmann-lr-all-stores.csv', model_type='linear-regression')
-#train_single_model(train, test, outfile='rossmann-rf-all-stores.csv', model_type='random-forest')
-#train_single_keras_model(train, test, outfile='rossmann-keras-all-stores.csv')
-#train_many_keras_models(train, test, outfile='rossmann-keras-per-store.csv', verbose=True)
+train_many_models(train, test, closed_store_ids, outfile='rossmann-lr-per-store.csv', model_type='linear-regression',
+                  verbose=False)
+#train_many_models(train, test, closed_store_ids, outfile='rossmann-rf-per-store.csv', model_type='random-forest', verbose=False)
+#train_many_models(train, test, closed_store_ids, outfile='rossmann-gb-per-store.csv', model_type='gradient-boosting', verbose=False)
+#train_single_model(train, test, closed_store_ids, outfile='rossmann-lr-all-stores.csv', model_type='linear-regression')
+#train_single_model(train, test, closed_store_ids, outfile='rossmann-rf-all-stores.csv', model_type='random-forest')
+#train_single_model(train, test, closed_store_ids, outfile='rossmann-gb-all-stores.csv', model_type='gradient-boosting')
+#train_single_keras_model(train, test, closed_store_ids, outfile='rossmann-keras-all-stores.csv')
+#train_many_keras_models(train, test, closed_store_ids, outfile='rossmann-keras-per-store.csv', verbose=True)
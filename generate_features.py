@@ -20,8 +20,8 @@ def one_hot_encode(df):
     df['SchoolHoliday'] = df['SchoolHoliday'].replace([0, 1], ['sch_hol_none', 'sch_hol_yes'])
     df['Open'] = df['Open'].replace([0, 1], ['open_no', 'open_yes'])
     df['Promo'] = df['Promo'].replace([0, 1], ['day_promo_none', 'day_promo_yes'])
-    df['StateHoliday'] = df['StateHoliday'].replace(['0', 'a', 'c'], ['state_hol_none', 'state_hol_public',
-                                                                      'state_hol_christmas'])
+    df['StateHoliday'] = pd.Categorical(df['StateHoliday'], categories=['0', 'a', 'b', 'c']).rename_categories(
+        ['state_hol_none', 'state_hol_public', 'state_hol_easter', 'state_hol_christmas'])
     df['StoreType'] = df['StoreType'].replace(['a', 'b', 'c', 'd'], ['store_type_a', 'store_type_b', 'store_type_c',
                                                                      'store_type_d'])
     df['Assortment'] = df['Assortment'].replace(['a', 'b', 'c'], ['assortment_a', 'assortment_b', 'assortment_c'])
@@ -35,14 +35,14 @@ def one_hot_encode(df):
     return df
 
 def generate_month(df):
-    df['Month'] = df['Date'].str[5:7]
-    df['Month'] = df['Month'].astype(int)
+    # parse the YYYY-MM-DD dates in one vectorized pass rather than slicing every string
+    df['Month'] = pd.to_datetime(df['Date'], format='%Y-%m-%d').dt.month.astype('int8')
     df = df.drop('Date', axis=1)
     return df
     
 def generate_is_in_competition(df):
     # construct datestamp YYYY-MM-DD for date of competition's opening
-    df['Date'] = pd.to_datetime(df['Date'])
+    df['Date'] = pd.to_datetime(df['Date'], format='%Y-%m-%d')
     df['DateOfCompetitionOpen'] = pd.to_datetime(df.CompetitionOpenSinceYear*10000 + df.CompetitionOpenSinceMonth*100 + 15,format='%Y%m%d')
 
     # now make the flag